@@ -1,19 +1,36 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, session, jsonify
+from flask import Flask, Response, render_template, stream_template, request, redirect, url_for, flash, send_from_directory, session, jsonify
 import os
 import tempfile
 import io
-import networkx as nx
-# 配置Matplotlib使用非交互式后端，避免线程安全问题
-import matplotlib
-matplotlib.use('Agg')  # 使用Agg后端，非交互式
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from PIL import Image
+import html
+import unicodedata
+import uuid
+import marshal
+import threading
+import time
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import numpy as np
 from xmindparser import xmind_to_dict
 
-# 设置中文显示
-plt.rcParams['font.sans-serif'] = ['SimHei']  # 用来正常显示中文标签
-plt.rcParams['axes.unicode_minus'] = False    # 用来正常显示负号
+# 优先使用lxml的C解析器流式读取content.xml，未安装时回退到标准库
+try:
+    from lxml import etree
+    # lxml可在C层按标签过滤事件，只把需要处理的元素交给Python；
+    # huge_tree解除libxml2默认的256层嵌套限制（每层主题占topic/children/topics三层元素），
+    # 同时解除单个文本节点10MB的限制，否则层级较深的思维导图无法解析
+    ITERPARSE_OPTIONS = {'tag': ('{*}sheet', '{*}topic', '{*}topics'), 'huge_tree': True}
+except ImportError:
+    import xml.etree.ElementTree as etree
+    ITERPARSE_OPTIONS = {}
+
+# matplotlib、networkx和numba体积较大且只在绘图时使用，首次用到时才导入，
+# 减少Web进程的启动时间和常驻内存
+_mpl = None
+_tree_layout_kernel = None
 
 # 创建Flask应用
 app = Flask(__name__)
@@ -29,19 +46,104 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 # 允许的文件扩展名
 ALLOWED_EXTENSIONS = {'xmind'}
 
+# content.xml中主题链接属性的完整名称
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+
+# 进程内的解析数据缓存（会话ID -> 解析后的画布列表），只保留最近的若干次上传
+_SHEET_CACHE = OrderedDict()
+_SHEET_CACHE_LOCK = threading.Lock()
+_SHEET_CACHE_SIZE = 8
+
+# 画布图片渲染进程池（首次使用时创建），每个子进程拥有独立的matplotlib状态
+_RENDER_EXECUTOR = None
+_RENDER_EXECUTOR_LOCK = threading.Lock()
+
+# 每个进程复用的画布Figure（渲染子进程一次只处理一个任务）
+_SHEET_FIG = None
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 def is_xmind_file(file_path):
-    """检查文件是否为有效的XMind文件"""
+    """检查文件是否为有效的XMind文件（只检查压缩包结构，不做完整解析）"""
     try:
-        # 直接尝试解析文件来验证
-        xmind_to_dict(file_path)
-        return True
-    except:
+        # XMind文件是包含content.xml（XMind 8）或content.json（XMind Zen）的zip压缩包
+        with zipfile.ZipFile(file_path) as z:
+            names = set(z.namelist())
+            return 'content.xml' in names or 'content.json' in names
+    except (zipfile.BadZipFile, OSError):
         return False
 
-# 后续已定义优化版本的parse_xmind_structure函数
+def parse_content_xml(source):
+    """流式解析XMind 8的content.xml，返回与xmind_to_dict结构一致的画布列表
+
+    只保留标题和attached子主题，主题元素处理完毕后立即清理以释放内存。
+    """
+    sheets = []
+    sheet = None
+    topic_stack = []    # 正在处理的主题，None表示不属于attached分支的主题
+    topics_types = []   # 外层<topics>元素的type属性
+    
+    for event, el in etree.iterparse(source, events=('start', 'end'), **ITERPARSE_OPTIONS):
+        if not isinstance(el.tag, str):
+            continue
+        tag = el.tag.rpartition('}')[2]
+        
+        if tag == 'topic' and sheet is not None:
+            if event == 'start':
+                topic = {'title': None}
+                if not topic_stack:
+                    sheet['topic'] = topic
+                elif topic_stack[-1] is not None and topics_types and topics_types[-1] == 'attached':
+                    topic_stack[-1].setdefault('topics', []).append(topic)
+                else:
+                    topic = None
+                topic_stack.append(topic)
+                continue
+            
+            # 结束时标题等直接子元素均已解析完成，子主题元素已被清理
+            topic = topic_stack.pop()
+            if topic is not None:
+                title_el = el.find('{*}title')
+                if el.find('{*}img') is not None:
+                    topic['title'] = '[Image]'
+                elif title_el is not None:
+                    topic['title'] = title_el.text
+                if (el.get(XLINK_HREF) or '').startswith('xap:attachments'):
+                    topic['title'] = '[Attachment]{0}'.format(topic['title'])
+            el.clear()
+        elif tag == 'topics':
+            if event == 'start':
+                topics_types.append(el.get('type'))
+            else:
+                topics_types.pop()
+        elif tag == 'sheet':
+            if event == 'start':
+                sheet = {}
+                topic_stack = []
+                continue
+            
+            title_el = el.find('{*}title')
+            if title_el is not None and title_el.text:
+                sheet['title'] = title_el.text
+            sheets.append(sheet)
+            sheet = None
+            el.clear()
+    
+    return sheets
+
+def load_xmind_file(file_path):
+    """解析XMind文件：XMind 8格式流式读取content.xml，其他格式交给xmindparser处理"""
+    with zipfile.ZipFile(file_path) as z:
+        names = set(z.namelist())
+        if 'content.xml' in names and 'content.json' not in names:
+            with z.open('content.xml') as f:
+                return parse_content_xml(f)
+    
+    # XMind Zen及更新版本使用content.json
+    return xmind_to_dict(file_path)
+
+# 后续已定义优化版本的iter_xmind_structure函数
 
 # 主页面
 @app.route('/')
@@ -82,29 +184,20 @@ def upload_file():
         parse_mode = request.form.get('parse_mode', 'list')
         
         # 解析XMind文件
-        xmind_data = xmind_to_dict(temp_file_path)
+        xmind_data = load_xmind_file(temp_file_path)
         
         if parse_mode == 'image':
-            # 为解析后的数据创建一个唯一的临时文件路径
-            import uuid
+            # 为解析后的数据生成唯一的会话ID，数据文件路径由服务端根据它拼出
             session_id = str(uuid.uuid4())
-            data_file_path = os.path.join(app.config['UPLOAD_FOLDER'], f'xmind_data_{session_id}.json')
             
-            # 将解析后的数据保存到临时文件中（使用JSON格式）
-            import json
-            with open(data_file_path, 'w', encoding='utf-8') as f:
-                # 自定义序列化函数处理复杂对象
-                def custom_serializer(obj):
-                    if isinstance(obj, bytes):
-                        return obj.decode('utf-8', errors='replace')
-                    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
-                
-                # 保存为JSON字符串
-                json.dump(xmind_data, f, ensure_ascii=False, default=custom_serializer)
+            # 解析后的数据直接保存在进程内缓存中，后续请求无需重新读取和解码；
+            # 同时写入临时文件，供进程重启后或其他工作进程加载
+            cache_xmind_data(session_id, xmind_data)
+            save_xmind_data(session_id, xmind_data)
             
-            # 开启session，只保存必要信息
+            # 开启session，只保存必要信息（不保存文件路径，避免客户端伪造）
             session.permanent = True
-            session['data_file_path'] = data_file_path
+            session['session_id'] = session_id
             session['filename'] = file.filename
             
             # 提取画布信息（只保存必要的元数据）
@@ -112,7 +205,9 @@ def upload_file():
             for i, sheet in enumerate(xmind_data):
                 sheets_info.append({
                     'id': i,
-                    'title': sheet.get('title', f'画布 {i+1}')
+                    'title': sheet.get('title', f'画布 {i+1}'),
+                    # 无标题的画布下载时沿用sheet_N.png的文件名
+                    'has_title': 'title' in sheet
                 })
             
             # 保存画布信息，标记解析为已完成
@@ -121,7 +216,6 @@ def upload_file():
             session['image_generation_started'] = False  # 图片生成尚未开始
             
             # 获取文件大小，用于前端提示
-            import time
             file_size = os.path.getsize(temp_file_path) / (1024 * 1024)  # MB
             
             # 渲染画布选择页面，为所有文件返回模板
@@ -135,11 +229,10 @@ def upload_file():
                                  file_size=file_size,
                                  large_file_warning=file_size > 20)
         else:
-            # 生成HTML结构（列表形式）
-            html_structure = parse_xmind_structure(xmind_data)
-            
-            # 渲染结果页面
-            return render_template('result.html', structure=html_structure)
+            # 生成HTML结构（列表形式），边遍历边流式输出结果页面，
+            # 无需先在内存中拼出完整的HTML，浏览器也能尽早开始渲染
+            html_chunks = iter_xmind_structure(xmind_data)
+            return Response(stream_template('result.html', structure=html_chunks), mimetype='text/html')
     
     except Exception as e:
         flash(f'解析文件时出错: {str(e)}')
@@ -156,12 +249,12 @@ def upload_file():
 # 获取特定画布的图片路由
 @app.route('/get_sheet_image/<int:sheet_id>')
 def get_sheet_image(sheet_id):
-    # 检查session中是否有解析数据文件路径
-    if 'data_file_path' not in session or 'sheets_info' not in session:
+    # 检查session中是否有有效的会话ID和画布信息
+    session_id = get_session_id()
+    if session_id is None or 'sheets_info' not in session:
         # 返回错误图片而不是重定向，避免前端交互中断
         return generate_error_image('未找到解析数据，请刷新页面'), 503
     
-    data_file_path = session['data_file_path']
     sheets_info = session['sheets_info']
     
     # 检查画布ID是否有效
@@ -173,18 +266,12 @@ def get_sheet_image(sheet_id):
         # 标记图片生成已开始
         session['image_generation_started'] = True
         
-        # 从临时文件加载解析后的数据
-        import json
-        with open(data_file_path, 'r', encoding='utf-8') as f:
-            xmind_data = json.load(f)
+        # 获取指定画布的图片（优先使用缓存）
+        png_name = ensure_sheet_png(session_id, sheet_id)
         
-        # 生成指定画布的图片
-        sheet_data = xmind_data[sheet_id]
-        img_buffer = generate_sheet_image(sheet_data)
-        
-        # 返回图片
-        return send_file(img_buffer, mimetype='image/png', as_attachment=False,
-                       download_name=f'sheet_{sheet_id}.png')
+        # 返回图片（直接发送磁盘文件，由WSGI服务器使用sendfile零拷贝传输）
+        return send_from_directory(app.config['UPLOAD_FOLDER'], png_name, mimetype='image/png',
+                                   as_attachment=False, download_name=f'sheet_{sheet_id}.png')
     
     except Exception as e:
         print(f'生成图片时出错: {str(e)}')
@@ -195,12 +282,12 @@ def get_sheet_image(sheet_id):
 # 下载特定画布的图片路由
 @app.route('/download_sheet_image/<int:sheet_id>')
 def download_sheet_image(sheet_id):
-    # 检查session中是否有解析数据文件路径
-    if 'data_file_path' not in session or 'sheets_info' not in session:
+    # 检查session中是否有有效的会话ID和画布信息
+    session_id = get_session_id()
+    if session_id is None or 'sheets_info' not in session:
         flash('没有找到解析数据，请重新上传文件')
         return redirect(url_for('index'))
     
-    data_file_path = session['data_file_path']
     sheets_info = session['sheets_info']
     
     # 检查画布ID是否有效
@@ -209,19 +296,14 @@ def download_sheet_image(sheet_id):
         return redirect(url_for('index'))
     
     try:
-        # 从临时文件加载解析后的数据
-        import json
-        with open(data_file_path, 'r', encoding='utf-8') as f:
-            xmind_data = json.load(f)
-        
-        # 生成指定画布的图片
-        sheet_data = xmind_data[sheet_id]
-        sheet_title = sheet_data.get('title', f'sheet_{sheet_id}')
-        img_buffer = generate_sheet_image(sheet_data)
+        # 获取指定画布的图片（优先使用缓存）
+        sheet_info = sheets_info[sheet_id]
+        sheet_title = sheet_info['title'] if sheet_info.get('has_title', True) else f'sheet_{sheet_id}'
+        png_name = ensure_sheet_png(session_id, sheet_id)
         
         # 下载图片
-        return send_file(img_buffer, mimetype='image/png', as_attachment=True,
-                       download_name=f'{sheet_title}.png')
+        return send_from_directory(app.config['UPLOAD_FOLDER'], png_name, mimetype='image/png',
+                                   as_attachment=True, download_name=f'{sheet_title}.png')
     
     except Exception as e:
         flash(f'生成图片时出错: {str(e)}')
@@ -253,43 +335,216 @@ def check_parsing_status():
     
     return jsonify(response_data)
 
+def get_subtopics(topic):
+    """返回主题的直接子主题列表（兼容列表和按方向分组的字典两种结构）"""
+    subtopics = topic.get('topics')
+    if isinstance(subtopics, list):
+        return subtopics
+    if isinstance(subtopics, dict):
+        return [t for group in subtopics.values() for t in group]
+    return []
+
+def flatten_sheet(sheet_data):
+    """将画布的主题树展开为扁平数组：(标题列表, 层级数组, 边起点数组, 边终点数组)
+
+    节点按先序遍历编号，根节点为0，父节点编号总是小于子节点编号。
+    """
+    labels = []
+    levels = []
+    src_list = []
+    dst_list = []
+    
+    if 'topic' in sheet_data:
+        # 栈元素为 (主题, 父节点ID, 层级)
+        stack = deque([(sheet_data['topic'], -1, 0)])
+        pop = stack.pop
+        push = stack.append
+        nid = 0
+        
+        while stack:
+            topic, parent, level = pop()
+            labels.append(topic.get('title', 'Untitled'))
+            levels.append(level)
+            if parent != -1:
+                src_list.append(parent)
+                dst_list.append(nid)
+            
+            # 逆序压栈，保证子主题按原顺序编号
+            for subtopic in reversed(get_subtopics(topic)):
+                push((subtopic, nid, level + 1))
+            nid += 1
+    
+    return (labels,
+            np.array(levels, dtype=np.int32),
+            np.array(src_list, dtype=np.int32),
+            np.array(dst_list, dtype=np.int32))
+
+def _tree_layout_ys(parents, n_children):
+    """逐节点计算树形布局的纵坐标（要求节点按先序编号，父节点编号小于子节点）"""
+    n = parents.shape[0]
+    ys = np.zeros(n, dtype=np.float64)
+    seen = np.zeros(n, dtype=np.int32)
+    for i in range(1, n):
+        p = parents[i]
+        count = n_children[p]
+        if count > 1:
+            spacing = min(8.0, count * 1.5)
+            ys[i] = ys[p] + spacing / (count - 1) * seen[p] - spacing / 2
+        else:
+            ys[i] = ys[p]
+        seen[p] += 1
+    return ys
+
+def get_tree_layout_kernel():
+    """首次调用时尝试用numba编译布局循环，numba为可选依赖，不可用时返回None"""
+    global _tree_layout_kernel
+    if _tree_layout_kernel is None:
+        try:
+            from numba import njit
+            _tree_layout_kernel = njit(cache=True)(_tree_layout_ys)
+        except Exception:
+            # 未安装numba，或缓存目录不可写（只读部署时njit(cache=True)会抛出RuntimeError），
+            # 记为不可用，之后直接使用NumPy实现，不再重复尝试
+            _tree_layout_kernel = False
+    return _tree_layout_kernel or None
+
+def compute_tree_layout(levels, src, dst):
+    """基于层次的树形布局（NumPy向量化实现），返回形状为(N, 2)的float32坐标数组
+
+    根节点位于(0, 0)，每下一层向左移动3个单位；同一父节点的子节点在父节点两侧
+    均匀分布，间距为 min(8, 子节点数 * 1.5)，只有一个子节点时与父节点对齐。
+    """
+    n = len(levels)
+    pos = np.zeros((n, 2), dtype=np.float32)
+    if n == 0:
+        return pos
+    
+    pos[:, 0] = -levels.astype(np.float32) * 3.0
+    if len(src) == 0:
+        return pos
+    
+    child_counts = np.bincount(src, minlength=n)
+    kernel = get_tree_layout_kernel()
+    if kernel is not None:
+        # 未安装numba时使用下方的NumPy向量化实现
+        parents = np.full(n, -1, dtype=np.int32)
+        parents[dst] = src
+        pos[:, 1] = kernel(parents, child_counts.astype(np.int32))
+        return pos
+    
+    # 以CSR形式按父节点分组子节点：indptr[p]:indptr[p+1] 为父节点p的子节点区间
+    indptr = np.concatenate(([0], np.cumsum(child_counts)))
+    order = np.argsort(src, kind='stable')
+    edge_parents = src[order]
+    indices = dst[order]
+    
+    # 子节点在兄弟中的序号及其相对父节点的垂直偏移
+    rank = np.arange(len(indices)) - indptr[edge_parents]
+    count = child_counts[edge_parents]
+    spacing = np.minimum(8.0, count * 1.5)
+    offset = np.where(count > 1,
+                      spacing / np.maximum(count - 1, 1) * rank - spacing / 2,
+                      0.0)
+    
+    parents = np.full(n, -1, dtype=np.int64)
+    parents[indices] = edge_parents
+    dy = np.zeros(n)
+    dy[indices] = offset
+    
+    # 逐层累加偏移：父节点总在上一层，因此每层只需一次向量化赋值
+    y = np.zeros(n)
+    by_level = np.argsort(levels, kind='stable')
+    bounds = np.cumsum(np.bincount(levels))
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        idx = by_level[start:end]
+        y[idx] = y[parents[idx]] + dy[idx]
+    
+    pos[:, 1] = y
+    return pos
+
 # 优化解析大文件的函数
-def parse_xmind_structure(xmind_data):
-    """高效地将XMind数据转换为HTML友好的结构"""
-    html_structure = []
-    
-    def traverse_topic(topic, level=0):
-        # 使用列表收集并一次性join，避免频繁字符串拼接
-        parts = []
-        parts.append(f"<div class='topic level-{level}'>")
-        parts.append(f"  <div class='topic-content'>{topic.get('title', 'Untitled')}</div>")
-        
-        if 'topics' in topic:
-            parts.append(f"  <div class='subtopics'>")
-            if isinstance(topic['topics'], list):
-                for subtopic in topic['topics']:
-                    parts.extend(traverse_topic(subtopic, level + 1))
-            elif isinstance(topic['topics'], dict):
-                for direction, subtopics in topic['topics'].items():
-                    for subtopic in subtopics:
-                        parts.extend(traverse_topic(subtopic, level + 1))
-            parts.append(f"  </div>")
-        
-        parts.append(f"</div>")
-        return parts
+def iter_xmind_structure(xmind_data, chunk_size=64 * 1024):
+    """高效地将XMind数据转换为HTML友好的结构（显式栈迭代遍历，避免深层递归）
+
+    以生成器形式按块（约chunk_size字节）输出HTML片段，供流式响应使用。
+    """
+    # 写入UTF-8字节缓冲区，累积到一定大小后输出并清空，内存占用只与块大小相关
+    buf = bytearray()
+    write = buf.extend
+    escape = html.escape
+    # 按层级缓存主题开头标签，格式化开销只与最大深度相关
+    level_open = {}
     
     # 处理所有画布
     for sheet in xmind_data:
-        html_structure.append(f"<div class='sheet'>")
-        html_structure.append(f"  <h2>{sheet.get('title', 'Untitled Sheet')}</h2>")
+        write(b"<div class='sheet'>\n<h2>")
+        write(escape(str(sheet.get('title', 'Untitled Sheet'))).encode('utf-8'))
+        write(b"</h2>\n")
         
         if 'topic' in sheet:
-            root_topic = sheet['topic']
-            html_structure.extend(traverse_topic(root_topic, 0))
+            # 栈元素为 (主题, 层级)，或需要原样输出的闭合标签字节串
+            stack = [(sheet['topic'], 0)]
+            pop = stack.pop
+            push = stack.append
+            
+            while stack:
+                item = pop()
+                if isinstance(item, bytes):
+                    write(item)
+                    continue
+                
+                topic, level = item
+                if len(buf) >= chunk_size:
+                    # 只在完整的HTML片段之间切分，不会截断多字节字符
+                    yield buf.decode('utf-8')
+                    buf.clear()
+                
+                open_tag = level_open.get(level)
+                if open_tag is None:
+                    open_tag = level_open[level] = f"<div class='topic level-{level}'><div class='topic-content'>".encode('utf-8')
+                write(open_tag)
+                write(escape(str(topic.get('title', 'Untitled'))).encode('utf-8'))
+                
+                if 'topics' not in topic:
+                    write(b"</div>\n</div>\n")
+                    continue
+                
+                write(b"</div>\n<div class='subtopics'>\n")
+                # 先压入闭合标签，待所有子主题输出完毕后再弹出
+                push(b"</div></div>\n")
+                
+                # 逆序压栈，保证子主题按原顺序输出
+                child_level = level + 1
+                for subtopic in reversed(get_subtopics(topic)):
+                    push((subtopic, child_level))
         
-        html_structure.append(f"</div>")
+        write(b"</div>\n")
     
-    return '\n'.join(html_structure)
+    if buf:
+        yield buf.decode('utf-8')
+
+def setup_matplotlib():
+    """首次调用时导入并配置matplotlib（非交互式后端、中文字体），返回创建Figure所需的类"""
+    global _mpl
+    if _mpl is None:
+        # 配置Matplotlib使用非交互式后端，避免线程安全问题
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        
+        # 设置字体支持中文，使用多种回退字体；只需在每个进程中设置一次
+        matplotlib.rcParams['font.sans-serif'] = ['SimHei', 'WenQuanYi Micro Hei', 'Heiti TC']
+        matplotlib.rcParams['axes.unicode_minus'] = False    # 用来正常显示负号
+        _mpl = (Figure, FigureCanvasAgg)
+    return _mpl
+
+def new_figure(**kwargs):
+    """创建绑定Agg画布的Figure，不经过pyplot的全局图形管理，用完无需close"""
+    Figure, FigureCanvas = setup_matplotlib()
+    fig = Figure(**kwargs)
+    FigureCanvas(fig)
+    return fig
 
 def generate_error_image(error_message):
     """生成包含错误信息的图片，而不是重定向"""
@@ -297,7 +552,8 @@ def generate_error_image(error_message):
     
     try:
         # 创建一个简单的错误提示图片
-        fig, ax = plt.subplots(figsize=(12, 6))
+        fig = new_figure(figsize=(12, 6))
+        ax = fig.add_subplot(111)
         
         # 设置背景色和文字
         ax.set_facecolor('#ffebee')
@@ -310,157 +566,137 @@ def generate_error_image(error_message):
         
         # 隐藏坐标轴
         ax.axis('off')
-        plt.tight_layout()
+        fig.tight_layout()
         
-        # 保存到缓冲区
-        plt.savefig(buffer, format='png', dpi=80, bbox_inches='tight')
+        # 由matplotlib直接编码为PNG写入缓冲区
+        fig.savefig(buffer, format='png', dpi=80, bbox_inches='tight')
         buffer.seek(0)
         
     except Exception as e:
         print(f'生成错误图片时出错: {str(e)}')
-    finally:
-        plt.close('all')
     
     return buffer
 
+def get_sheet_figure():
+    """获取本进程复用的画布Figure，避免每次渲染都重新分配大尺寸画布"""
+    global _SHEET_FIG
+    if _SHEET_FIG is None:
+        _SHEET_FIG = new_figure(figsize=(24, 18))
+    return _SHEET_FIG
+
+def estimate_label_widths(labels, font_sizes):
+    """估算每个标签的绘制宽度（磅）：全角字符按1个字宽，其余字符按0.6个字宽计算"""
+    em = np.fromiter((sum(1.0 if unicodedata.east_asian_width(ch) in 'WF' else 0.6 for ch in label)
+                      for label in labels), dtype=np.float64, count=len(labels))
+    return em * font_sizes
+
+def cull_overlapping_labels(screen_pos, labels, font_sizes, dpi):
+    """返回不会相互重叠的标签的节点编号
+
+    按标签的中位宽度把屏幕横向分为若干列（树形布局中同一层级的节点横坐标相同），
+    每列内自下而上扫描，与上一个保留的标签垂直距离小于最大字体高度的标签被跳过。
+    """
+    if not len(labels):
+        return np.arange(0)
+    
+    px_per_pt = dpi / 72
+    min_gap = font_sizes.max() * px_per_pt
+    col_width = max(min_gap, np.median(estimate_label_widths(labels, font_sizes)) * px_per_pt)
+    cols = np.floor(screen_pos[:, 0] / col_width).astype(np.int64)
+    order = np.lexsort((screen_pos[:, 1], cols))
+    
+    keep = []
+    last_col, last_y = None, 0.0
+    for i, col, y in zip(order.tolist(), cols[order].tolist(), screen_pos[order, 1].tolist()):
+        if col != last_col or y - last_y >= min_gap:
+            keep.append(i)
+            last_col, last_y = col, y
+    return np.sort(np.array(keep, dtype=np.int64))
+
 def generate_sheet_image(sheet_data):
     """为单个画布生成更清晰的图像（使用非交互式后端，避免线程安全问题）"""
+    import networkx as nx
+    from matplotlib.collections import LineCollection
+    
     # 创建图片缓冲区
     buffer = io.BytesIO()
+    fig = get_sheet_figure()
     
     try:
-        # 创建更高级的网络图布局
-        G = nx.DiGraph()
-        node_labels = {}
+        # 先将主题树展开为扁平数组，再批量构建网络图
+        labels, levels_arr, src_arr, dst_arr = flatten_sheet(sheet_data)
         
-        # 递归遍历主题，构建网络图和节点属性
-        def traverse_graph(topic, parent=None, node_id=0, level=0):
-            current_id = node_id
-            title = topic.get('title', 'Untitled')
-            
-            # 添加当前节点和属性
-            G.add_node(current_id, title=title, level=level)
-            node_labels[current_id] = title
-            
-            # 连接父节点
-            if parent is not None:
-                G.add_edge(parent, current_id)
-            
-            # 处理子主题
-            next_id = current_id + 1
-            child_count = 0
-            
-            if 'topics' in topic:
-                if isinstance(topic['topics'], list):
-                    for subtopic in topic['topics']:
-                        next_id = traverse_graph(subtopic, current_id, next_id, level + 1)
-                        child_count += 1
-                elif isinstance(topic['topics'], dict):
-                    for direction, subtopics in topic['topics'].items():
-                        for subtopic in subtopics:
-                            next_id = traverse_graph(subtopic, current_id, next_id, level + 1)
-                            child_count += 1
-            
-            # 返回更新后的ID和子节点数量
-            return next_id
-        
-        # 开始构建图
-        if 'topic' in sheet_data:
-            traverse_graph(sheet_data['topic'])
-        
-        # 创建图像
-        plt.figure(figsize=(24, 18))
-        
-        # 设置字体支持中文，使用多种回退字体
-        plt.rcParams['font.sans-serif'] = ['SimHei', 'WenQuanYi Micro Hei', 'Heiti TC']
-        plt.rcParams['axes.unicode_minus'] = False
-        
-        # 使用更智能的布局算法
-        # 计算节点层次
-        levels = {n: d['level'] for n, d in G.nodes(data=True)}
-        
-        # 创建基于层次的位置布局
-        pos = {}
-        # 根节点居中放置
-        root_nodes = [n for n, d in G.in_degree() if d == 0]
-        if root_nodes:
-            root = root_nodes[0]
-            pos[root] = (0, 0)
-            
-            # 为每个层次安排位置
-            level_nodes = {0: [root]}
-            for level in range(max(levels.values()) + 1):
-                if level not in level_nodes:
-                    continue
-                    
-                for node in level_nodes[level]:
-                    children = list(G.successors(node))
-                    child_count = len(children)
-                    
-                    if child_count > 0:
-                        # 为子节点分配位置，避免重叠
-                        if level not in level_nodes:
-                            level_nodes[level] = []
-                        
-                        level_nodes[level + 1] = level_nodes.get(level + 1, []) + children
-                        
-                        # 计算子节点的垂直间距
-                        if child_count == 1:
-                            # 只有一个子节点，居中
-                            pos[children[0]] = (pos[node][0] - 3, pos[node][1])
-                        else:
-                            # 多个子节点，均匀分布
-                            spacing = min(8, child_count * 1.5)  # 根据子节点数量调整间距
-                            start_y = pos[node][1] - (spacing / 2)
-                            
-                            for i, child in enumerate(children):
-                                pos[child] = (pos[node][0] - 3, start_y + (spacing / (child_count - 1) * i) if child_count > 1 else start_y)
-        
-        # 如果pos为空，使用spring布局作为备选
-        if not pos:
-            pos = nx.spring_layout(G, seed=42, k=0.3, iterations=100)
+        G = nx.DiGraph()
+        G.add_nodes_from((i, {'title': title, 'level': level})
+                         for i, (title, level) in enumerate(zip(labels, levels_arr.tolist())))
+        G.add_edges_from(zip(src_arr.tolist(), dst_arr.tolist()))
+        
+        # 根据节点数量调整画布尺寸和分辨率：小图不必光栅化整张大画布，大图也不会无限增大
+        n_nodes = G.number_of_nodes()
+        width = min(60, max(8, n_nodes ** 0.5))
+        dpi = 80 if n_nodes > 2000 else 100
+        fig.set_size_inches(width, width * 0.75)
+        fig.set_dpi(dpi)
+        
+        # 复用本进程的Figure，只新建坐标轴
+        ax = fig.add_subplot(111)
+        
+        # 思维导图是树，使用基于层次的树形布局（向量化计算），仅在绘图前转换为字典；
+        # 若不是单棵树（存在多个连通分量），则按层级分组使用shell布局，不再使用代价较高的spring布局
+        if G.number_of_edges() == G.number_of_nodes() - 1:
+            pos_array = compute_tree_layout(levels_arr, src_arr, dst_arr)
+        else:
+            level_groups = [np.flatnonzero(levels_arr == level).tolist()
+                            for level in np.unique(levels_arr)]
+            shell_pos = nx.shell_layout(G, nlist=level_groups)
+            pos_array = np.array([shell_pos[n] for n in range(len(labels))], dtype=np.float32).reshape(-1, 2)
         
         # 为不同层级的节点设置不同颜色
-        node_colors = []
-        for n, d in G.nodes(data=True):
-            level = d.get('level', 0)
-            # 使用层次相关的颜色
-            colors = ['#FFD700', '#98FB98', '#87CEFA', '#DDA0DD', '#FFA07A', '#F0E68C']
-            color_idx = min(level, len(colors) - 1)
-            node_colors.append(colors[color_idx])
-        
-        # 调整节点大小
-        node_sizes = [2500 + len(label) * 50 for label in node_labels.values()]
+        colors = np.array(['#FFD700', '#98FB98', '#87CEFA', '#DDA0DD', '#FFA07A', '#F0E68C'])
+        node_colors = colors[np.minimum(levels_arr, len(colors) - 1)]
+        
+        # 根据标签长度一次性计算节点大小和字体大小
+        label_lens = np.fromiter(map(len, labels), dtype=np.int32, count=len(labels))
+        node_sizes = 2500 + label_lens * 50
+        font_sizes = np.clip(120.0 / (label_lens + 1.0), 8.0, 12.0).astype(np.int32)
+        
+        # 直接用matplotlib集合绘制：所有边为一个LineCollection，所有节点为一次scatter
+        if len(src_arr):
+            segments = pos_array[np.stack([src_arr, dst_arr], axis=1)]  # 形状为(E, 2, 2)
+            ax.add_collection(LineCollection(segments, colors='gray', linewidths=1.5, zorder=1))
+        ax.scatter(pos_array[:, 0], pos_array[:, 1], s=node_sizes, c=node_colors, alpha=0.9,
+                   edgecolors='gray', zorder=2)
+        ax.margins(0.1)
+        ax.autoscale_view()
         
-        # 绘制节点
-        nx.draw_networkx_nodes(G, pos, node_size=node_sizes, node_color=node_colors, alpha=0.9, edgecolors='gray')
-        
-        # 绘制边，使用不同宽度
-        nx.draw_networkx_edges(G, pos, edge_color='gray', width=1.5, arrows=True, arrowsize=20)
+        # 设置标题
+        ax.set_title(sheet_data.get('title', 'Untitled Sheet'), fontsize=20, fontfamily='SimHei', pad=20)
+        ax.axis('off')
+        # 先确定坐标轴的最终位置，标签剔除使用的屏幕坐标才与输出图片一致
+        fig.tight_layout()
         
-        # 绘制标签，调整字体大小
-        font_sizes = [min(12, max(8, 120 / (len(label) + 1))) for label in node_labels.values()]
+        # 标签剔除：会与已绘制标签重叠、在图上无法辨认的标签不再绘制，
+        # 因此节点较密时部分标签会被省略，完整的主题内容可在列表模式中查看
+        visible = cull_overlapping_labels(ax.transData.transform(pos_array), labels, font_sizes, fig.dpi)
+        pos = dict(zip(visible.tolist(), map(tuple, pos_array[visible].tolist())))
         
-        # 单独绘制每个标签以控制字体大小
-        for node, label in node_labels.items():
-            size = min(12, max(8, 120 / (len(label) + 1)))
-            nx.draw_networkx_labels(G.subgraph([node]), pos, {node: label}, font_size=size, font_family='SimHei', font_weight='bold')
-        
-        # 设置标题
-        plt.title(sheet_data.get('title', 'Untitled Sheet'), fontsize=20, fontfamily='SimHei', pad=20)
-        plt.axis('off')
-        plt.tight_layout()
+        # 按字体大小分组，每组只调用一次绘制，避免为每个节点构建子图
+        visible_sizes = font_sizes[visible]
+        for size in np.unique(visible_sizes):
+            nodes = visible[visible_sizes == size].tolist()
+            labels_of_size = {node: labels[node] for node in nodes}
+            nx.draw_networkx_labels(G, pos, labels=labels_of_size, font_size=int(size), font_family='SimHei', font_weight='bold', ax=ax)
         
         # 保存到缓冲区
-        plt.savefig(buffer, format='png', dpi=100, bbox_inches='tight', facecolor='white')
+        fig.savefig(buffer, format='png', dpi=dpi, bbox_inches='tight', facecolor='white')
         buffer.seek(0)
         
     except Exception as e:
-        # 捕获所有异常，确保plt.close()执行
+        # 捕获所有异常，确保Figure被清空
         print(f"生成图片时出错: {str(e)}")
     finally:
-        # 清理当前图形，避免内存泄漏
-        plt.close('all')  # 关闭所有图形，更彻底的清理
+        # 清空本次绘制的内容，Figure本身保留供下次复用
+        fig.clf()
     
     return buffer
 
@@ -473,44 +709,149 @@ def xmind_to_image(xmind_data):
     main_sheet = xmind_data[0]
     return generate_sheet_image(main_sheet)
 
+def get_session_id():
+    """读取session中的会话ID并校验其为UUID，返回规范格式的字符串；无效时返回None
+
+    会话ID会拼进写入磁盘的文件名，必须拒绝客户端伪造的任意字符串。
+    """
+    try:
+        return str(uuid.UUID(session.get('session_id')))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+def get_data_file_path(session_id):
+    """根据会话ID在服务端拼出解析数据文件的路径"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], f'xmind_data_{session_id}.marshal')
+
+def cache_xmind_data(session_id, xmind_data):
+    """将解析后的数据放入进程内缓存，超出容量时淘汰最久未使用的数据"""
+    with _SHEET_CACHE_LOCK:
+        _SHEET_CACHE[session_id] = xmind_data
+        _SHEET_CACHE.move_to_end(session_id)
+        while len(_SHEET_CACHE) > _SHEET_CACHE_SIZE:
+            _SHEET_CACHE.popitem(last=False)
+
+def save_xmind_data(session_id, xmind_data):
+    """将解析后的数据以marshal格式写入临时文件
+
+    解析结果只包含dict/list/str等基本类型，marshal读写都比JSON快，
+    且加载时不会像pickle那样执行任意代码，任何进程都可以安全地读取。
+    """
+    with open(get_data_file_path(session_id), 'wb') as f:
+        marshal.dump(xmind_data, f)
+
+def load_xmind_data(session_id):
+    """获取解析后的数据：优先读取进程内缓存，未命中时从marshal临时文件加载"""
+    with _SHEET_CACHE_LOCK:
+        xmind_data = _SHEET_CACHE.get(session_id)
+        if xmind_data is not None:
+            _SHEET_CACHE.move_to_end(session_id)
+            return xmind_data
+    
+    try:
+        with open(get_data_file_path(session_id), 'rb') as f:
+            xmind_data = marshal.load(f)
+    except FileNotFoundError:
+        raise FileNotFoundError('解析数据已过期，请重新上传文件')
+    cache_xmind_data(session_id, xmind_data)
+    return xmind_data
+
+def get_render_executor():
+    """获取渲染进程池，不存在时创建"""
+    global _RENDER_EXECUTOR
+    with _RENDER_EXECUTOR_LOCK:
+        if _RENDER_EXECUTOR is None:
+            # 使用spawn启动子进程，避免在多线程的Web服务进程中fork
+            _RENDER_EXECUTOR = ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                                   mp_context=multiprocessing.get_context('spawn'))
+        return _RENDER_EXECUTOR
+
+def discard_render_executor(executor):
+    """丢弃已损坏的渲染进程池，下次调用get_render_executor时重新创建"""
+    global _RENDER_EXECUTOR
+    with _RENDER_EXECUTOR_LOCK:
+        # 其他线程可能已经换上了新的进程池，只丢弃当前损坏的这一个
+        if _RENDER_EXECUTOR is executor:
+            _RENDER_EXECUTOR = None
+    executor.shutdown(wait=False)
+
+def render_sheet_worker(sheet_data):
+    """在渲染子进程中执行：生成画布图片并返回PNG字节"""
+    return generate_sheet_image(sheet_data).getvalue()
+
+def _render_sheet_png(session_id, sheet_id):
+    """渲染指定画布的PNG字节（结果由ensure_sheet_png缓存在磁盘上）"""
+    xmind_data = load_xmind_data(session_id)
+    # 在子进程中渲染，CPU密集的绘图不再占用Web进程的GIL，多个请求可以并行渲染；
+    # 任一子进程异常退出（如渲染大图时被OOM终止）后整个进程池不可再用，需要重建后重试一次
+    for attempt in range(2):
+        executor = get_render_executor()
+        try:
+            png_bytes = executor.submit(render_sheet_worker, xmind_data[sheet_id]).result()
+            break
+        except BrokenProcessPool as e:
+            discard_render_executor(executor)
+            if attempt:
+                raise RuntimeError('渲染进程异常退出，画布可能过大') from e
+    if not png_bytes:
+        # 渲染失败时抛出异常，避免空结果被缓存
+        raise RuntimeError('图片渲染结果为空')
+    return png_bytes
+
+def ensure_sheet_png(session_id, sheet_id):
+    """确保画布图片已写入上传目录，返回其文件名（供send_from_directory直接发送）"""
+    png_name = f'xmind_sheet_{session_id}_{sheet_id}.png'
+    png_path = os.path.join(app.config['UPLOAD_FOLDER'], png_name)
+    if os.path.exists(png_path):
+        return png_name
+    
+    png_bytes = _render_sheet_png(session_id, sheet_id)
+    # 先写入临时文件再原子替换，避免并发请求读到写了一半的图片
+    fd, tmp_path = tempfile.mkstemp(prefix='xmind_sheet_', suffix='.tmp', dir=app.config['UPLOAD_FOLDER'])
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(png_bytes)
+        os.replace(tmp_path, png_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return png_name
+
 # 清理临时数据文件的函数
 def cleanup_temp_files():
-    """清理过期的临时数据文件"""
+    """清理过期的临时数据文件和画布图片缓存"""
     try:
-        import time
         current_time = time.time()
         # 清理超过2小时的文件
         max_age = 2 * 3600
         
-        for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-            if filename.startswith('xmind_data_') and filename.endswith('.json'):
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                if os.path.exists(file_path):
-                    file_age = current_time - os.path.getmtime(file_path)
-                    if file_age > max_age:
-                        try:
-                            os.remove(file_path)
-                        except:
-                            pass
+        # scandir一次遍历即可拿到文件名和状态信息
+        with os.scandir(app.config['UPLOAD_FOLDER']) as entries:
+            for entry in entries:
+                filename = entry.name
+                if not ((filename.startswith('xmind_data_') and filename.endswith('.marshal')) or
+                        (filename.startswith('xmind_sheet_') and filename.endswith(('.png', '.tmp')))):
+                    continue
+                try:
+                    if current_time - entry.stat().st_mtime > max_age:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
     except:
         # 忽略清理过程中的错误
         pass
 
-# 每次请求后尝试清理过期文件和管理缓存
-@app.after_request
-def after_request(response):
-    # 异步清理临时文件，避免阻塞响应
-    import threading
-    threading.Thread(target=cleanup_temp_files).start()
-    
-    # 限制缓存大小，避免内存占用过大
-    if 'image_cache' in globals():
-        max_cache_size = 10  # 最多缓存10张图片
-        if len(image_cache) > max_cache_size:
-            # 删除最早添加的缓存项
-            first_key = next(iter(image_cache))
-            del image_cache[first_key]
-    return response
+def _cleanup_loop(interval=60):
+    """后台线程：定期清理过期文件"""
+    while True:
+        cleanup_temp_files()
+        time.sleep(interval)
+
+# 启动唯一的后台清理线程，不再在每次请求后新建线程；渲染子进程导入本模块时不启动
+if multiprocessing.parent_process() is None:
+    _cleaner = threading.Thread(target=_cleanup_loop, daemon=True)
+    _cleaner.start()
 
 # 错误处理
 @app.errorhandler(413)